@@ -1,48 +1,60 @@
 import ee
 import pandas as pd
-import concurrent.futures
 
 ee.Initialize()
 
 # Get DW image collection for a random year
 DW = (ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1')
     .filter(ee.Filter.date('2019-01-01', '2019-12-31'))
-    .map(lambda image: image.set('crs', image.projection().crs()))
     )
 
-print(DW.first().get('crs').getInfo())
-
 # Create list of all UTM epsg codes; 
 # UTM codes range from 1 to 60, starting with 326 in the northern hemisphere and 327 in the southern hemisphere
 utm_epsg_codes = [f"EPSG:326{zone:02d}" for zone in range(1, 61)] + [f"EPSG:327{zone:02d}" for zone in range(1, 61)]
 
-# Function to get affine transform for a given UTM epsg code
-def get_affine_transform(utm_epsg_code):
-    print(f"Getting affine transform for {utm_epsg_code}")
-    img = DW.filter(ee.Filter.eq('crs', utm_epsg_code)).first().getInfo()
+# MGRS latitude bands (the letter after the zone number in the tile id) north and south of the equator
+NORTH_BANDS = 'NPQRSTUVWX'
+SOUTH_BANDS = 'CDEFGHJKLM'
+
+# Function to build the (server-side) projection info for a given UTM epsg code
+def get_zone_info(utm_epsg_code):
+    # Image ids end with the MGRS tile (e.g. '..._T10SEG'), which encodes the UTM zone and latitude band,
+    # so a representative image for the zone can be found from metadata alone.
+    zone = utm_epsg_code[-2:]
+    bands = NORTH_BANDS if utm_epsg_code.startswith('EPSG:326') else SOUTH_BANDS
+    zone_filter = ee.Filter.Or(*[ee.Filter.stringContains('system:index', f'_T{zone}{band}') for band in bands])
+    img = ee.Image(DW.filter(zone_filter).first())
 
-    transform = img['bands'][0].get('crs_transform', None)
+    return ee.Dictionary({
+        'crs': utm_epsg_code,
+        'projection': img.select(0).projection(),
+        'index': img.get('system:index')
+    })
+
+# Function to get affine transform from the client-side zone info
+def get_affine_transform(zone_info):
+    transform = zone_info['projection']['transform']
 
     # Manually correct second scale parameter in transform; should be negative [10, 0, 390450, 0, 10, 6090450]
     transform = transform[:4] + [-abs(transform[4])] + transform[5:]
 
-    UTM_zone = img['properties'].get('system:index', None).split('_')[-1]
+    UTM_zone = zone_info['index'].split('_')[-1]
 
     return {
-        'crs': utm_epsg_code,
+        'crs': zone_info['crs'],
         'transform': transform,
         'UTM_zone': UTM_zone
     }
 
-# Fetch affine transforms in parallel
-with concurrent.futures.ThreadPoolExecutor(max_workers=18) as executor:
-    affine_transforms = dict(zip(utm_epsg_codes, executor.map(get_affine_transform, utm_epsg_codes)))
+# Fetch projection info for every zone with a single request
+zone_infos = ee.List([get_zone_info(utm_epsg_code) for utm_epsg_code in utm_epsg_codes]).getInfo()
+affine_transforms = {info['crs']: get_affine_transform(info) for info in zone_infos}
 
 # Create pandas dataframe from dict 
 lut = pd.DataFrame(affine_transforms).T
 
-# Save dataframe to csv
-lut.to_csv('dw_UTM_crs_lut.csv', index=False)
+# Save dataframe to parquet (keeps the transforms as lists rather than strings)
+lut.to_parquet('dw_UTM_crs_lut.parquet', index=False)
 
 # test for first row
-utm_epsg_code = utm_epsg_codes[1]
\ No newline at end of file
+utm_epsg_code = utm_epsg_codes[1]
@@ -1,82 +1,86 @@
 # General imports:
-import numpy as np
-import rioxarray as rxr
-import xarray as xr
-import matplotlib.pyplot as plt
 import geopandas as gpd
-from shapely.geometry import mapping
-import cartopy.crs as ccrs 
 import os
 import yaml
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # Google Earth Engine imports:
 import ee
 import geemap
-from google.auth import default
+from ee_utils import get_info, start_task
 import certifi
 import ssl
 
+# Read the lookup table with UTM zone transforms (built by dw_UTM_crs_lut.py) once.
+LUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dw_UTM_crs_lut.parquet')
+UTM_TRANSFORMS = {row.crs: row.transform.tolist() for row in pd.read_parquet(LUT_PATH).itertuples()}
+
+# Thread pool for I/O-bound Earth Engine requests, shared across calls (threads are started
+# lazily and reused once idle, so repeated calls don't pay for a new pool).
+EE_POOL = ThreadPoolExecutor(max_workers=64)
+
+@lru_cache(maxsize=8)
+def _read_aoi(path, mtime):
+    """Read the AOI geojson, cached on path and modification time."""
+    return gpd.read_file(path)
+
+def read_aoi(path):
+    """Given path to geojson, return the AOI as a GeoDataFrame (parsed once per file version)."""
+    return _read_aoi(path, os.path.getmtime(path))
+
 def get_boundaries(path):
     """Given path to geojson, return AOI as an ee Geometry object."""
 
     # Load the geojson.
-    aoi_file = gpd.read_file(path)
+    aoi_file = read_aoi(path)
     
     # Convert the GeoPandas geometry to GeoJSON.
     aoi_geom = aoi_file.iloc[0].geometry.__geo_interface__
     
-    # Convert to an ee Geometry object.
-    ee_polygon = ee.Geometry(aoi_geom)
+    # Convert to an ee Geometry object (planar edges in EPSG:4326, as in the geojson).
+    ee_polygon = ee.Geometry(aoi_geom, opt_proj='EPSG:4326', opt_geodesic=False)
         
     return(ee_polygon)
 
 
 def check_pct_null(image, aoi, crs, crs_transform):
-    # Get the internal mask of the image and invert so nodata is 1.
-    nodata_mask = image.mask().Not()
-
-    # Get the number of non-null pixels with .count().
-    total_pixels = image.reduceRegion(
-        reducer=ee.Reducer.count(), 
-        geometry=aoi, 
-        maxPixels=1e8).get('label')
+    # Get the internal mask of the label band (1 = valid) and its inverse (1 = nodata).
+    valid_mask = image.select('label').mask().rename('valid')
+    nodata_mask = valid_mask.Not().rename('nodata')
 
-
-    # Get the number of nodata pixels from the mask.
-    nodata_pixels = nodata_mask.reduceRegion(
+    # Sum both masks in a single pass to get the number of valid and nodata pixels.
+    pixel_counts = valid_mask.addBands(nodata_mask).reduceRegion(
         reducer=ee.Reducer.sum(), 
         geometry=aoi, 
-        maxPixels=1e8).get('label')
+        crs=crs,
+        crsTransform=crs_transform,
+        maxPixels=1e8)
+
+    valid_pixels = ee.Number(pixel_counts.get('valid'))
+    nodata_pixels = ee.Number(pixel_counts.get('nodata'))
 
     # Compute percentage of nodata pixels
-    pct_nodata = nodata_pixels.multiply(100).divide(total_pixels.add(nodata_pixels))
+    pct_nodata = nodata_pixels.multiply(100).divide(valid_pixels.add(nodata_pixels))
 
     return pct_nodata
 
-# TODO: Switch to using lookup table approach here
-def get_utm_projection(geojson_path, geometry):
+@lru_cache(maxsize=256)
+def _get_utm_projection(geojson_path, mtime):
     """
     Get the UTM projection for the AOI using geopandas, using transform from Dynamic World.
     """
     
     # Get the UTM zone CRS from geopandas.
-    gdf = gpd.read_file(geojson_path)
+    gdf = _read_aoi(geojson_path, mtime)
     utm_crs = gdf.estimate_utm_crs()
     epsg = utm_crs.to_epsg()
     target_crs = f'EPSG:{epsg}'
 
-    # Get the Dynamic World collection that intersects the AOI.
-    collection = ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1').filterBounds(geometry)
-    
-    # Read the lookup table csv with UTM zone transforms.
-    lut_df = pd.read_csv('dw_UTM_crs_lut.csv')
-
     # Get the transform from the lookup table for the target CRS.
-    transform_row = lut_df[lut_df['crs'] == target_crs]
-    
-    if not transform_row.empty:
-        transform = transform_row['transform'].values[0]
+    if target_crs in UTM_TRANSFORMS:
+        transform = UTM_TRANSFORMS[target_crs]
         print(f"Using transform from lookup table for {target_crs}, transform: {transform}")
     else:
         raise ValueError(f"UTM transform not found for {target_crs}")
@@ -86,17 +90,68 @@ def get_utm_projection(geojson_path, geometry):
         'transform': transform # Use the transform from the lookup table
     }
 
-def n_valid_pixels(image, aoi):
+def get_utm_projection(geojson_path):
     """
-    Get number of valid pixels in an image for a given AOI
+    Get the UTM projection for the AOI (cached on path and modification time).
     """
-    # Get the number of non-null pixels with .count().
-    total_pixels = image.reduceRegion(
-        reducer=ee.Reducer.count(), 
-        geometry=aoi, 
-        maxPixels=1e8).get('label')
+    return _get_utm_projection(geojson_path, os.path.getmtime(geojson_path))
 
-    return total_pixels
+def make_daily_composite(imcol, date):
+    """
+    Composite all images in the collection from a single day (date given as YYYY-MM-dd).
+    """
+    # Set start date (inclusive) and end date (exclusive) to get only images from one day.
+    ee_start_date = ee.Date(date)
+    ee_end_date = ee_start_date.advance(1, 'day')
+
+    # Filter the image collection to the start and end dates.
+    date_col = imcol.filterDate(ee_start_date, ee_end_date)
+
+    # For class bands, calculate mean probability across all pixels, and for the label band,
+    # reduce to the most probable land cover type (using mode reducer), in a single pass.
+    lc_bands = ['water', 'trees', 'grass', 'flooded_vegetation', 
+                'crops', 'shrub_and_scrub', 'built', 'bare', 'snow_and_ice']
+    combined_reducer = ee.Reducer.mean().forEach(lc_bands) \
+        .combine(ee.Reducer.mode().forEach(['label']), sharedInputs=False)
+
+    # Output bands keep their input names (the class bands followed by the label band).
+    # Days with a single image don't need reducing, so just mosaic those.
+    date_col = date_col.select(lc_bands + ['label'])
+    n_images = date_col.size()
+    dw_composite = ee.Image(ee.Algorithms.If(n_images.eq(1),
+                                             date_col.mosaic(),
+                                             date_col.reduce(combined_reducer))).toFloat()
+
+    return dw_composite.set({'date': date, 'n_images': n_images})
+
+def make_export_task(dw_composite, date_str, aoi, out_dir, utm_proj):
+    """
+    Build (without starting) the Google Drive export task for a daily composite.
+    """
+    # Construct output file path.
+    file_name = f'composite_{date_str}'
+
+    # Clip the composite (rather than every input image) to only the AOI.
+    dw_composite = dw_composite.clip(aoi)
+
+    # Set the NoData Value to -9999
+    # https://developers.google.com/earth-engine/guides/exporting_images#nodata
+    noDataVal = -9999
+    dw_composite = dw_composite.unmask(noDataVal, sameFootprint = True)
+
+    # Export the dynamic world data as a GeoTIFF.
+    task = ee.batch.Export.image.toDrive(dw_composite, 
+                                        description = file_name,
+                                        folder = out_dir,
+                                        region = aoi,
+                                        crs = utm_proj['crs'],
+                                        crsTransform = utm_proj['transform'],
+                                        maxPixels = 1E7, # Setting max to 1 million pixels (~1000km^2 with 10m pixels) as safeguard
+                                        fileFormat = 'GeoTIFF',
+                                        formatOptions = {'cloudOptimized': True,
+                                                         'noData': noDataVal})
+
+    return task
 
 def fetch_dynamic_world(aoi, start_date, end_date, out_dir, utm_proj):
     """
@@ -109,68 +164,35 @@ def fetch_dynamic_world(aoi, start_date, end_date, out_dir, utm_proj):
     # Load the Dynamic World image collection for the aoi and dates of interest.
     imcol = (ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1')
              .filterBounds(aoi)
-             .filterDate(start_date, end_date)
-             # Clip to only the AOI.
-             .map(lambda image: image.clip(aoi))
-             # Calculate number of valid pixels.
-             .map(lambda image: image.set('n_valid_pixels', n_valid_pixels(image, aoi)))
-             # Filter out images with no valid pixels.
-             .filter(ee.Filter.gt('n_valid_pixels', 0)))
-
-    # Get list of dates in the collection (more efficient method than previous).
+             .filterDate(start_date, end_date))
+
+    # Get list of dates in the collection (kept server-side).
     unique_dates = imcol.aggregate_array('system:time_start') \
         .map(lambda date: ee.Date(date).format('YYYY-MM-dd')) \
-        .distinct() \
-        .getInfo()
+        .distinct()
+
+    # Build the daily composites server-side and attach the percent nodata over the AOI.
+    composites = ee.ImageCollection(unique_dates.map(
+        lambda date: make_daily_composite(imcol, date)))
+    composites = composites.map(lambda image: image.set(
+        'pct_nodata', check_pct_null(image, aoi, utm_proj['crs'], utm_proj['transform'])))
+
+    # Filter out composites with no valid pixels and get their dates in a single request.
+    valid_dates = get_info(composites.filter(ee.Filter.lt('pct_nodata', 100)).aggregate_array('date'))
 
     # Initialize list to store export tasks.
     tasks = []  
 
-    for date in unique_dates:
-    
-        # Set start date (inclusive) and end date (exclusive) to get only images from one day.
-        date_str = str(date)
-        ee_start_date = ee.Date(date_str)
-        ee_end_date = ee_start_date.advance(1, 'day')
+    for date_str in valid_dates:
 
         print(f'Computing composite for date: {date_str}')
 
-        # Filter the image collection to the start and end dates.
-        date_col = imcol.filterDate(ee_start_date, ee_end_date)
-
-        # For label band, reduce to the most probable land cover type (using mode reducer).
-        dw_label_composite = date_col.select('label').mode().toFloat()
-
-        # For other bands, calculate mean probability across all pixels.        
-        lc_bands = ['water', 'trees', 'grass', 'flooded_vegetation', 
-                    'crops', 'shrub_and_scrub', 'built', 'bare', 'snow_and_ice']
-        dw_bands_composite = date_col.select(lc_bands).mean().toFloat()
-
-        # Combine the label band to the other class bands.
-        dw_composite = dw_bands_composite.addBands(dw_label_composite)
-
-        # Construct output file path.
-        file_name = f'composite_{date_str}'
-
-        # Set the NoData Value to -9999
-        # https://developers.google.com/earth-engine/guides/exporting_images#nodata
-        noDataVal = -9999
-        dw_composite.unmask(noDataVal, sameFootprint = True)
-
-        # Export the dynamic world data as a GeoTIFF.
-        task = ee.batch.Export.image.toDrive(dw_composite, 
-                                            description = file_name,
-                                            folder = out_dir,
-                                            region = aoi,
-                                            crs = utm_proj['crs'],
-                                            crsTransform = utm_proj['transform'],
-                                            maxPixels = 1E7, # Setting max to 1 million pixels (~1000km^2 with 10m pixels) as safeguard
-                                            fileFormat = 'GeoTIFF',
-                                            formatOptions = {'cloudOptimized': True,
-                                                             'noData': noDataVal})
-        
-        tasks.append(task)
-        task.start()
+        dw_composite = make_daily_composite(imcol, date_str)
+
+        tasks.append(make_export_task(dw_composite, date_str, aoi, out_dir, utm_proj))
+
+    # Start the export tasks concurrently, since each start is a separate request to Earth Engine.
+    for date_str, _ in zip(valid_dates, EE_POOL.map(start_task, tasks)):
         print(f"Export task started for {date_str}")
 
     return tasks
@@ -179,9 +201,10 @@ if __name__ == "__main__":
     # Create a context using the certifi bundle.
     context = ssl.create_default_context(cafile=certifi.where())
 
-    # Initialize earth engine and geemap.
+    # Initialize earth engine and geemap (using the high-volume endpoint, since this
+    # script issues many automated requests rather than interactive ones).
     #ee.Authenticate() # Only need to authenticate once. 
-    ee.Initialize(opt_url="https://earthengine.googleapis.com", project="dynamic-world-pipeline")
+    ee.Initialize(opt_url="https://earthengine-highvolume.googleapis.com", project="dynamic-world-pipeline")
     geemap.ee_initialize()
 
     # Read config information from yml file.
@@ -197,7 +220,7 @@ if __name__ == "__main__":
     aoi = get_boundaries(aoi_path)
 
     # Get UTM projection and transform from center of AOI.
-    utm_proj = get_utm_projection(aoi_path, aoi)
+    utm_proj = get_utm_projection(aoi_path)
 
     # Call function to export dynamic world raster.
     tasks = fetch_dynamic_world(aoi, start_date, end_date, out_dir, utm_proj)
@@ -1,71 +1,283 @@
 # General imports:
 import numpy as np
-import rioxarray as rxr
-import xarray as xr
-import matplotlib.pyplot as plt
 import geopandas as gpd
-from shapely.geometry import mapping
-import cartopy.crs as ccrs 
 import os
+import shutil
+import json
+import math
+import hashlib
+import random
 import yaml
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from osgeo import gdal
 
 # Google Earth Engine imports:
 import ee
-import geemap
-from google.auth import default
+from ee_utils import get_info
+from google.auth.transport.requests import Request
 import certifi
 import ssl
 
+# Earth Engine project, and the high-volume endpoint (suited to many parallel automated requests).
+EE_PROJECT = "dynamic-world-pipeline"
+EE_HIGHVOLUME_URL = "https://earthengine-highvolume.googleapis.com"
+
+# Width/height of each downloaded tile in pixels (keeps each computePixels response well under
+# its size limit), and the number of tiles to download concurrently.
+TILE_SIZE = 2048
+N_WORKERS = 25
+
+# Create a context using the certifi bundle (used for the tile download connections).
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+# Name of the index file (in out_dir) that maps cached requests to exported files.
+CACHE_INDEX = '.dynamic_world_cache.json'
+
+# Meters per degree at the equator, as used by Earth Engine to convert a scale in meters to EPSG:4326.
+METERS_PER_DEGREE = 111319.49079327357
+
+def initialize_ee():
+    """Initialize Earth Engine against the high-volume endpoint."""
+    # No http_transport is passed: the client already sends its requests through a shared, 
+    # pooled requests.Session, so connections are reused between requests.
+    ee.Initialize(opt_url=EE_HIGHVOLUME_URL, project=EE_PROJECT)
+
+@lru_cache(maxsize=16)
+def _read_aoi(path, mtime):
+    """Read the AOI geojson, cached on path and modification time."""
+    return gpd.read_file(path)
+
+def read_aoi(path):
+    """Given path to geojson, return the AOI as a GeoDataFrame (parsed once per file version)."""
+    return _read_aoi(path, os.path.getmtime(path))
+
 def get_boundaries(path):
     """Given path to geojson, return AOI as an ee Geometry object."""
 
     # Load the geojson.
-    aoi_file = gpd.read_file(path)
+    aoi_file = read_aoi(path)
     
     # Convert the GeoPandas geometry to GeoJSON.
     aoi_geom = aoi_file.iloc[0].geometry.__geo_interface__
     
-    # Convert to an ee Geometry object.
-    ee_polygon = ee.Geometry(aoi_geom)
+    # Convert to an ee Geometry object (planar edges in EPSG:4326, as in the geojson).
+    ee_polygon = ee.Geometry(aoi_geom, opt_proj='EPSG:4326', opt_geodesic=False)
         
     return(ee_polygon)
 
-def get_bbox(path):
-    """Given path to geojson, return AOI bounding box."""
+@lru_cache(maxsize=32)
+def _get_bbox(path, mtime):
+    """Build the AOI bounding box geometry, cached on path and modification time."""
 
     # Load the geojson.
-    aoi_file = gpd.read_file(path)
+    aoi_file = _read_aoi(path, mtime)
 
     # Calculate the bounding box [minx, miny, maxx, maxy].
     bounds = aoi_file.total_bounds 
     
     # Create an ee.Geometry object from the bounding box.
-    aoi = ee.Geometry.Rectangle([bounds[0], bounds[1], bounds[2], bounds[3]])
+    aoi = ee.Geometry.Rectangle(bounds.tolist(), proj='EPSG:4326', geodesic=False)
     
     return(aoi)
 
-def check_pct_null(image, aoi):
-    # Get the internal mask of the image and invert so nodata is 1.
-    nodata_mask = image.mask().Not()
+def get_bbox(path):
+    """Given path to geojson, return AOI bounding box."""
+    return _get_bbox(path, os.path.getmtime(path))
 
-    # Get the number of non-null pixels with .count().
-    total_pixels = image.reduceRegion(
-        reducer=ee.Reducer.count(), geometry=aoi, scale=10, maxPixels=1e8
-    ).get('label_mode').getInfo()
+def check_pct_null(image, aoi, scale=80):
+    # Get the internal mask of the image (1 = valid) and invert it so nodata is 1.
+    valid_mask = image.mask().rename('valid')
+    nodata_mask = valid_mask.Not().rename('nodata')
 
-    # Get the number of nodata pixels from the mask.
-    nodata_pixels = nodata_mask.reduceRegion(
-        reducer=ee.Reducer.sum(), geometry=aoi, scale=10, maxPixels=1e8
-    ).get('label_mode').getInfo()
+    # Sum both masks in a single reduction to get the number of nodata and valid pixels.
+    # The nodata percentage is insensitive to resolution, so this runs at a coarser scale than 
+    # the 10m export (letting Earth Engine coarsen further if the AOI is very large).
+    pixel_counts = nodata_mask.addBands(valid_mask).reduceRegion(
+        reducer=ee.Reducer.sum().forEach(['nodata', 'valid']), geometry=aoi, scale=scale, 
+        bestEffort=True, maxPixels=1e7
+    )
 
-    # Calculate the percentage of nodata pixels.
-    pct_nodata = (nodata_pixels / (total_pixels + nodata_pixels)) * 100
+    # Calculate the percentage of nodata pixels server-side.
+    nodata_pixels = ee.Number(pixel_counts.get('nodata'))
+    pct_nodata = nodata_pixels.divide(nodata_pixels.add(pixel_counts.get('valid'))).multiply(100)
 
     return pct_nodata
 
-def fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir):
+def get_tile_grids(bounds, scale=10, tile_size=TILE_SIZE):
+    """
+    Split a bounding box into a fishnet of pixel grids that can be requested with computePixels.
+    
+    Inputs:
+    bounds    : bounding box [minx, miny, maxx, maxy] in EPSG:4326
+    scale     : pixel size in meters
+    tile_size : width and height of each tile in pixels
+    
+    Outputs:
+    tiles : list of (row, col, grid) tuples, where grid is a computePixels PixelGrid dict
+    """
+    minx, miny, maxx, maxy = bounds
+
+    # Convert the pixel size to degrees and get the full raster dimensions.
+    pixel_size = scale / METERS_PER_DEGREE
+    width = math.ceil((maxx - minx) / pixel_size)
+    height = math.ceil((maxy - miny) / pixel_size)
+
+    tiles = []
+    for row, y_offset in enumerate(range(0, height, tile_size)):
+        for col, x_offset in enumerate(range(0, width, tile_size)):
+            grid = {
+                'dimensions': {'width': min(tile_size, width - x_offset),
+                               'height': min(tile_size, height - y_offset)},
+                'affineTransform': {'scaleX': pixel_size, 'shearX': 0,
+                                    'translateX': minx + x_offset * pixel_size,
+                                    'shearY': 0, 'scaleY': -pixel_size,
+                                    'translateY': maxy - y_offset * pixel_size},
+                'crsCode': 'EPSG:4326',
+            }
+            tiles.append((row, col, grid))
+
+    return tiles
+
+def _auth_headers(credentials):
+    """Build the REST API headers for the Earth Engine credentials, billed to EE_PROJECT."""
+    return {'Authorization': f'Bearer {credentials.token}', 'x-goog-user-project': EE_PROJECT}
+
+async def download_tile(session, semaphore, credentials, refresh_lock, url, body, out_path, max_retries=3):
+    """
+    Download one tile from the computePixels REST endpoint, backing off on rate limits and server errors
+    (and refreshing the access token if it has expired).
+    """
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            token = credentials.token
+            async with session.post(url, json=body, headers=_auth_headers(credentials)) as response:
+                # Refresh the access token when it has expired (once, for all tiles that hit the expiry).
+                if response.status == 401 and attempt < max_retries:
+                    async with refresh_lock:
+                        if credentials.token == token:
+                            await asyncio.to_thread(credentials.refresh, Request())
+                    continue
+
+                # Retry when Earth Engine is rate limiting requests (HTTP 429) or has a transient error.
+                if (response.status == 429 or response.status >= 500) and attempt < max_retries:
+                    await asyncio.sleep(min(60, 2 ** attempt) + random.random())
+                    continue
+
+                response.raise_for_status()
+
+                # Stream the response to a temporary file in 1 MB chunks (rather than holding the whole 
+                # tile in memory), then move it into place so partial tiles are never left behind.
+                tmp_path = out_path + '.part'
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(1 << 20):
+                            f.write(chunk)
+                    os.replace(tmp_path, out_path)
+                except BaseException:
+                    # Remove the partial tile if the download fails or is cancelled.
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                break
+
+    return out_path
+
+async def download_tiles(image, tile_grids, tile_dir):
+    """
+    Download tiles of an ee.Image concurrently (at most N_WORKERS at a time) from a single process.
+    """
+    # Get an access token for the REST API from the credentials saved by ee.Authenticate(), 
+    # and build the request for each tile.
+    credentials = ee.data.get_persistent_credentials()
+    credentials.refresh(Request())
+    refresh_lock = asyncio.Lock()
+    url = f'{EE_HIGHVOLUME_URL}/v1/projects/{EE_PROJECT}/image:computePixels'
+    expression = ee.serializer.encode(image, for_cloud_api=True)
+
+    # Share one pool of keep-alive connections (verified against the certifi bundle) across all tiles,
+    # so each request after the first reuses an open TLS connection instead of a new handshake.
+    semaphore = asyncio.Semaphore(N_WORKERS)
+    connector = aiohttp.TCPConnector(ssl=SSL_CONTEXT, limit=N_WORKERS, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        downloads = [download_tile(session, semaphore, credentials, refresh_lock, url,
+                                   {'expression': expression, 'fileFormat': 'GEO_TIFF', 'grid': grid},
+                                   os.path.join(tile_dir, f'tile_{row}_{col}.tif'))
+                     for row, col, grid in tile_grids]
+
+        return await asyncio.gather(*downloads)
+
+def run_async(coro):
+    """
+    Run a coroutine to completion, in a worker thread if an event loop is already running 
+    (e.g. in a Jupyter kernel, where asyncio.run() can't be called).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def export_tiled(image, bounds, out_path, scale=10, lazy=False):
+    """
+    Export an ee.Image over a bounding box to a GeoTIFF, downloading tiles in parallel and mosaicking them.
+    If lazy is True, only the VRT mosaic of the tiles is written and its path is returned.
+    """
+    # Start from an empty tile directory, so tiles left by an earlier (interrupted) run are never reused.
+    tile_dir = os.path.splitext(out_path)[0] + '_tiles'
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.makedirs(tile_dir)
+    tile_paths = run_async(download_tiles(image, get_tile_grids(bounds, scale), tile_dir))
+
+    # Mosaic the tiles with a VRT and write it out as a single (compressed, tiled) Cloud-Optimized GeoTIFF.
+    vrt_path = os.path.splitext(out_path)[0] + '.vrt'
+    vrt = gdal.BuildVRT(vrt_path, tile_paths)
+    if vrt is None:
+        raise Exception(f"Failed to build a VRT of the tiles in {tile_dir}.")
+    if lazy:
+        vrt = None
+        return vrt_path
+
+    out_ds = gdal.Translate(out_path, vrt, format='COG',
+                            creationOptions=['COMPRESS=DEFLATE', 'PREDICTOR=YES',
+                                             'BLOCKSIZE=512', 'NUM_THREADS=ALL_CPUS'])
+    if out_ds is None:
+        raise Exception(f"Failed to write the Cloud-Optimized GeoTIFF {out_path} (tiles kept in {tile_dir}).")
+    out_ds = vrt = None
+
+    # The tiles and VRT are only needed to build the GeoTIFF, so remove them once it is written.
+    shutil.rmtree(tile_dir)
+    os.remove(vrt_path)
+
+    return out_path
+
+def _cache_key(aoi_path, date, date_buffer, nodata_threshold):
+    """Hash the AOI geojson contents and composite parameters into a cache key."""
+    with open(aoi_path, 'rb') as f:
+        aoi_bytes = f.read()
+
+    params = f'{date}|{date_buffer}|{nodata_threshold}'.encode()
+
+    return hashlib.sha1(aoi_bytes + params).hexdigest()
+
+def _read_key(path):
+    """Read the cache key stored alongside an exported file (None if the file or key is missing)."""
+    if not (os.path.exists(path) and os.path.exists(path + '.key')):
+        return None
+
+    with open(path + '.key', 'r') as f:
+        return f.read().strip()
+
+def fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir, lazy=False):
     """
     Function to acquire Dynamic World raster for a specific polygon and date range.
+
+    Exports are cached in out_dir, so repeating a request with the same AOI and parameters 
+    returns the previously exported file without contacting Earth Engine.
     
     Inputs:
     aoi         : ee.Geometry.Polygon defining the area of interest
@@ -73,82 +285,161 @@ def fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir):
     date_buffer : number of days to buffer date parameter with on either side
                   (e.g. start_date = date - date_buffer & 
                    end_date = date + date_buffer)
+    lazy        : if True, skip writing the mosaicked GeoTIFF and return a lazy (dask-backed)
+                  handle on a VRT of the tiles instead. All tiles are still downloaded on the 
+                  first call; this only saves the GeoTIFF translate step (later lazy calls 
+                  reuse the cached VRT and tiles)
     
     Outputs:
-    xr_ds : xarray Dataset containing the Dynamic World data composited over time period.
+    out_path : path to the GeoTIFF of the Dynamic World data composited over time period, or
+    xr_da    : (if lazy) xarray DataArray of the composite; select a subset before calling .compute()
+    """
+    # Load the cache index (mapping cache keys to exported files) if there is one.
+    cache_path = os.path.join(out_dir, CACHE_INDEX)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+
+    # If this request has already been exported (and the file is still the one written for it), use it.
+    # Lazy requests can also reuse the VRT (and tiles) from an earlier lazy run, cached under key + ':vrt'.
+    key = _cache_key(aoi_path, date, date_buffer, nodata_threshold)
+    cache_keys = [key, key + ':vrt'] if lazy else [key]
+    cached = [cache[k] for k in cache_keys if k in cache and _read_key(cache[k]) == key]
+    if cached:
+        out_path = cached[0]
+        print(f"Using cached dynamic world composite {out_path}")
+
+    else:
+        out_path = _fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir, key, lazy)
+        if not os.path.exists(out_path):
+            raise Exception(f"Dynamic world export {out_path} was not written.")
+
+        # Record the export (or the VRT of its tiles, for lazy runs) in the cache index, 
+        # with its key written alongside the file.
+        with open(out_path + '.key', 'w') as f:
+            f.write(key)
+        cache[key + ':vrt' if lazy else key] = out_path
+
+        # A full export removes the tiles and VRT, so drop any VRT cached by an earlier lazy run.
+        if not lazy and key + ':vrt' in cache:
+            vrt_key_path = cache.pop(key + ':vrt') + '.key'
+            if os.path.exists(vrt_key_path):
+                os.remove(vrt_key_path)
+
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+
+    if lazy:
+        import rioxarray as rxr
+        return rxr.open_rasterio(out_path, chunks={'x': 512, 'y': 512}, lock=False, masked=False)
+
+    return out_path
+
+def filter_window(imcol, date, date_buffer):
+    """Filter a collection to the window of date_buffer days on either side of date."""
+    return imcol.filterDate(ee.Date(date).advance(-date_buffer, 'day'), 
+                            ee.Date(date).advance(date_buffer, 'day'))
+
+def mode_composite(imcol):
     """
-    # Use date_buffer to set the start and end date surrounding date of interest.
-    start_date = ee.Date(date).advance(-date_buffer, 'day')
-    end_date = ee.Date(date).advance(date_buffer, 'day')
+    Reduce a collection of 'label' images to the most frequent land cover class in each pixel.
+
+    Counts the occurrences of each class with one-hot images and takes the argmax, which is cheaper 
+    than ee.Reducer.mode() for the 9 discrete Dynamic World classes. Ties go to the lower class 
+    number, as with mode().
+    """
+    # Compare each label image to every class number (one band per class) and count matches per pixel.
+    classes = ee.Image.constant(list(range(9)))
+    class_counts = imcol.map(lambda image: image.eq(classes)).sum()
+
+    # The index of the most frequent class is the class number (cast to a byte band, as classes are 0-8).
+    return class_counts.toArray().arrayArgmax().arrayGet([0]).toUint8().rename('label_mode')
+
+def get_window_stats(imcol, date, date_buffer, aoi):
+    """
+    Get the (server-side) number of images and percent nodata of the composite for one window.
+    """
+    window_col = filter_window(imcol, date, date_buffer)
+    n_images = window_col.size()
+
+    # Reduce to the most probable land cover type and calculate percent nodata (empty windows are all nodata).
+    pct_nodata = ee.Algorithms.If(n_images.gt(0), 
+                                  check_pct_null(mode_composite(window_col), aoi), 
+                                  100)
+
+    return ee.Dictionary({
+        'n_images': n_images,
+        'pct_nodata': pct_nodata
+    })
+
+def _fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir, key, lazy=False):
+    """
+    Find the smallest date buffer with enough data and export its composite (uncached).
+    """
+    # Candidate date buffers: start from date_buffer and increase by 15 days until reaching 180.
+    date_buffers = [date_buffer]
+    while date_buffers[-1] < 180:
+        date_buffers.append(date_buffers[-1] + 15)
     
     # Get aoi bounding box polygon.
     aoi = get_bbox(aoi_path)
     
-    # Load the Dynamic World image collection for the aoi and dates of interest.
-    imcol = (ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1')
-             .filterBounds(aoi)
-             .filterDate(start_date, end_date)
-             .select('label') # 'Label' contains the band index of highest probability land cover class for each pixel.
-            )
-
-    # Get the list of dates in the collection
-    dates = imcol.aggregate_array('system:time_start').getInfo()
-    print(f'Full Dates: {dates}')
-    dates = [np.datetime64(ee.Date(date).format('YYYY-MM-dd').getInfo()) for date in dates]
-    print(f'Dynamic World Data Dates: {dates}')
-
-    # If there is no data available, increase the date_buffer and re-run function.
-    if len(dates) < 1:
-        # If date_buffer exceeds 180, stop the recursion.
-        if date_buffer >= 180:
-            raise Exception(f"No Dynamic World data found within {date_buffer} days of the target date. Stopping recursion.")
-        
-        date_buffer += 15
-        print(f"No dynamic world data is available within this time period. Increasing date buffer to: {date_buffer} and re-running.")
+    # Load the Dynamic World image collection for the aoi over the largest window.
+    imcol = filter_window(ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1').filterBounds(aoi), date, date_buffers[-1]) \
+        .select('label') # 'Label' contains the band index of highest probability land cover class for each pixel.
 
-        # Re-run the function recursively with new date_buffer.
-        return fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir)
+    # Evaluate every candidate window (and get the image timestamps) in a single request.
+    result = get_info(ee.Dictionary({
+        'time_starts': imcol.aggregate_array('system:time_start'),
+        'windows': ee.List([get_window_stats(imcol, date, buffer, aoi) for buffer in date_buffers])
+    }))
+    windows = result['windows']
 
-    # Reduce to the most probable land cover type and calculate percent nodata.
-    dw_composite = imcol.reduce(ee.Reducer.mode())
-    pct_nodata = check_pct_null(dw_composite, aoi)
-    
-    # If the percent nodata is greater than the threshold, increase data_buffer and re-run function.
-    if pct_nodata > nodata_threshold:
-        # If date_buffer exceeds 180, stop the recursion.
-        if date_buffer >= 180:
-            raise Exception(f"Not enough Dynamic World data found within {date_buffer} days of the target date. Stopping recursion.")
-        
-        date_buffer += 15
-        print(f"The amount of nodata in the image was: {pct_nodata}. Increasing date buffer to: {date_buffer} and re-running.")
+    # Convert the timestamps (epoch milliseconds) to unique dates locally.
+    dates = np.unique(np.array(result['time_starts'], dtype='datetime64[ms]').astype('datetime64[D]'))
+    target_date = np.datetime64(date, 'D')
 
-        # Re-run the function recursively with new date_buffer.
-        return fetch_dynamic_world(aoi_path, date, date_buffer, nodata_threshold, out_dir)
-    
-    # Otherwise, if there is enough data, export the composite.
+    # Pick the smallest date buffer that has data and is under the nodata threshold.
+    for buffer, window in zip(date_buffers, windows):
+        window_dates = dates[(dates >= target_date - buffer) & (dates < target_date + buffer)]
+        print(f"Dynamic World Data Dates within {buffer} days: {window_dates}")
+
+        if window['n_images'] > 0 and window['pct_nodata'] <= nodata_threshold:
+            date_buffer = buffer
+            break
+
+        if window['n_images'] == 0:
+            print(f"No dynamic world data is available within {buffer} days of the target date.")
+        else:
+            print(f"The amount of nodata in the image within {buffer} days was: {window['pct_nodata']}.")
     else:
-        # Convert ee.Date to human-readable strings.
-        start_date_str = start_date.format('YYYYMMdd').getInfo() 
-        end_date_str = end_date.format('YYYYMMdd').getInfo()
+        if window['n_images'] == 0:
+            raise Exception(f"No Dynamic World data found within {buffer} days of the target date.")
+        raise Exception(f"Not enough Dynamic World data found within {buffer} days of the target date.")
 
-        # Construct output file path.
-        out_path = os.path.join(out_dir, f'dynamic_world_{start_date_str}_{end_date_str}.tif')
-        
-        # Export the dynamic world data as a GeoTIFF.
-        geemap.ee_export_image(dw_composite, filename = out_path, scale = 10, region = aoi)
-        print(f"Exported dynamic world composite to {out_path}")
-        
-        return out_path
+    # Reduce the chosen window to the most probable land cover type.
+    dw_composite = mode_composite(filter_window(imcol, date, date_buffer))
 
+    # Use date_buffer to set the start and end date surrounding date of interest (formatted locally).
+    start_date_str = (target_date - date_buffer).item().strftime('%Y%m%d')
+    end_date_str = (target_date + date_buffer).item().strftime('%Y%m%d')
 
-if __name__ == "__main__":
-    # Create a context using the certifi bundle.
-    context = ssl.create_default_context(cafile=certifi.where())
+    # Construct output file path (unique to the cache key, so different AOIs never share a file).
+    out_path = os.path.join(out_dir, f'dynamic_world_{start_date_str}_{end_date_str}_{key[:12]}.tif')
+    
+    # Export the dynamic world data as a GeoTIFF.
+    bounds = read_aoi(aoi_path).total_bounds
+    out_path = export_tiled(dw_composite, bounds, out_path, scale = 10, lazy = lazy)
+    print(f"Exported dynamic world composite to {out_path}")
+    
+    return out_path
 
-    # Initialize earth engine and geemap.
+
+if __name__ == "__main__":
+    # Initialize earth engine.
     ee.Authenticate()
-    ee.Initialize(opt_url="https://earthengine.googleapis.com", project="dynamic-world-pipeline")
-    geemap.ee_initialize()
+    initialize_ee()
 
     # Read config information from yml file.
     with open("config.yml", "r") as yml:
@@ -0,0 +1,45 @@
+# General imports:
+import random
+import time
+from functools import wraps
+
+# Google Earth Engine imports:
+import ee
+from googleapiclient.errors import HttpError
+
+# Maximum number of attempts for Earth Engine requests that are rate limited.
+MAX_TRIES = 5
+
+def _is_rate_limited(error):
+    """Check whether an Earth Engine error is a (transient) rate limit or quota error."""
+    message = str(error).lower()
+    return any(text in message for text in ('429', 'too many requests', 'rate limit', 'quota'))
+
+def ee_retry(fn):
+    """
+    Decorator that retries a function making Earth Engine requests when it is rate limited,
+    with exponential backoff and jitter (up to MAX_TRIES attempts).
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_TRIES):
+            try:
+                return fn(*args, **kwargs)
+            except (ee.EEException, HttpError) as e:
+                if not _is_rate_limited(e) or attempt == MAX_TRIES - 1:
+                    raise
+                wait = min(60, 2 ** attempt) + random.random()
+                print(f"Earth Engine request was rate limited, retrying in {wait:.1f} seconds.")
+                time.sleep(wait)
+
+    return wrapper
+
+@ee_retry
+def get_info(obj):
+    """Fetch the value of a server-side Earth Engine object (retrying when rate limited)."""
+    return obj.getInfo()
+
+@ee_retry
+def start_task(task):
+    """Start an Earth Engine export task (retrying when rate limited)."""
+    task.start()